@@ -0,0 +1,42 @@
+# Attendance DB - Shared SQLite helpers for all pages
+# Author: Ahmad Kraiem
+# Description: Schema migrations and cache keys shared by the pages that open the attendance database.
+
+# ========== Imports ==========
+import os
+
+
+# ========== Cache Keys ==========
+def db_signature(db_path):
+    """Modification times of the database and its WAL file, for use as the cache key of @st.cache_data readers.
+    Every write changes it (in WAL mode only the -wal file's mtime moves), so readers should set max_entries=1.
+    """
+    return tuple(os.path.getmtime(path) if os.path.exists(path) else 0 for path in (db_path, db_path + "-wal"))
+
+
+# ========== Migrations ==========
+def _has_time_s(conn):
+    return "time_s" in {row[1] for row in conn.execute("PRAGMA table_info(attendance)")}
+
+def ensure_time_s_column(conn):
+    """Add and backfill attendance.time_s (seconds since midnight, NULL for absences) on older databases.
+    conn must be in autocommit mode (isolation_level=None). The check is repeated under BEGIN IMMEDIATE, so two
+    pages opening an old database at once add the column only once instead of failing on a duplicate column.
+    """
+    if _has_time_s(conn):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not _has_time_s(conn):
+            conn.execute("ALTER TABLE attendance ADD COLUMN time_s INTEGER")
+            conn.execute("""
+                UPDATE attendance
+                SET time_s = CAST(substr(time, 1, 2) AS INTEGER) * 3600
+                           + CAST(substr(time, 4, 2) AS INTEGER) * 60
+                           + CAST(substr(time, 7, 2) AS INTEGER)
+                WHERE time LIKE '__:__:__'
+            """)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
@@ -0,0 +1,160 @@
+# Encodings Store - Shared known-face encodings for all pages
+# Author: Ahmad Kraiem
+# Description: Loads the saved face encodings once per server process and keeps the packed copy in sync.
+
+# ========== Imports ==========
+import os
+
+# Default OpenBLAS/OpenMP to every core for dlib's face encoder. This only reaches libraries loaded after this
+# point: Streamlit has already imported numpy before any page runs, so in practice it is the BLAS dlib loads,
+# which is why the pages import this module before dlib / face_recognition.
+os.environ.setdefault("OPENBLAS_NUM_THREADS", str(os.cpu_count()))
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count()))
+
+import json
+import threading
+import numpy as np
+import streamlit as st
+
+try:
+    import faiss
+except ImportError:  # faiss is optional; callers fall back to a NumPy GEMV over the matrix
+    faiss = None
+
+# ========== Paths ==========
+ENCODING_DIR = "encodings"
+PACKED_ENCODINGS_PATH = os.path.join(ENCODING_DIR, "encodings.bin")  # raw float32, shape (N, 128)
+PACKED_NAMES_PATH = os.path.join(ENCODING_DIR, "names.json")  # row-aligned "<name>_<reg>" labels
+
+
+# ========== Loading ==========
+def _packed_is_current(known_names, just_saved=None):
+    """True when names.json covers exactly the .npy files on disk and none of them is newer than encodings.bin.
+    just_saved is the student update_packed_encodings() is about to append, whose .npy was just rewritten.
+    """
+    packed_mtime = os.path.getmtime(PACKED_ENCODINGS_PATH)
+    stems = set()
+    for entry in os.scandir(ENCODING_DIR):
+        if entry.name.endswith(".npy"):
+            stem = entry.name[:-len(".npy")]
+            stems.add(stem)
+            if stem != just_saved and entry.stat().st_mtime > packed_mtime:
+                return False
+    return stems == set(known_names) | ({just_saved} if just_saved else set())
+
+def _load_packed_names(just_saved=None):
+    # names.json if both packed files exist, agree on the row count and are current; None otherwise
+    if not (os.path.exists(PACKED_ENCODINGS_PATH) and os.path.exists(PACKED_NAMES_PATH)):
+        return None
+    with open(PACKED_NAMES_PATH) as f:
+        known_names = json.load(f)
+    if os.path.getsize(PACKED_ENCODINGS_PATH) != len(known_names) * 128 * 4:
+        return None
+    if not _packed_is_current(known_names, just_saved):
+        return None
+    return known_names
+
+def load_packed_encodings():
+    """Read encodings.bin / names.json written by update_packed_encodings().
+    Returns (None, None) when they are missing, out of sync, or older than the .npy files
+    (a student added, removed or restored by hand), so callers rebuild them from the .npy files.
+    """
+    known_names = _load_packed_names()
+    if known_names is None:
+        return None, None
+    return np.fromfile(PACKED_ENCODINGS_PATH, dtype=np.float32).reshape(-1, 128), known_names
+
+def rebuild_packed_encodings():
+    """Rewrite encodings.bin / names.json from the per-student .npy files, which stay the source of truth."""
+    # Downcast each file's float64 encodings once, then join them into one contiguous (N, 128)
+    # float32 matrix so matching is a single single-precision GEMV per face
+    chunks = []
+    known_names = []
+    for file in sorted(os.listdir(ENCODING_DIR)):
+        if file.endswith(".npy"):
+            encs = np.load(os.path.join(ENCODING_DIR, file), allow_pickle=True)
+            chunks.append(np.asarray(encs, dtype=np.float32).reshape(-1, 128))
+            known_names.extend([file.replace(".npy", "")] * len(chunks[-1]))
+    known_matrix = np.concatenate(chunks) if chunks else np.empty((0, 128), dtype=np.float32)
+    known_matrix.tofile(PACKED_ENCODINGS_PATH)
+    with open(PACKED_NAMES_PATH, "w") as f:
+        json.dump(known_names, f)
+    return known_matrix, known_names
+
+def load_known_faces():
+    known_matrix, known_names = load_packed_encodings()
+    if known_matrix is None:
+        known_matrix, known_names = rebuild_packed_encodings()
+
+    # (display name, lowercase full name, reg no) per row, parsed once per student instead of per recognized face
+    info_by_name = {}
+    for name_with_reg in dict.fromkeys(known_names):
+        name_part, reg_no = name_with_reg.rsplit("_", 1)
+        full_name = name_part.replace("_", " ").strip().lower()
+        info_by_name[name_with_reg] = (full_name.title(), full_name, reg_no)
+    display_info = [info_by_name[name_with_reg] for name_with_reg in known_names]
+    return known_matrix, known_names, display_info
+
+
+# ========== Shared Cache ==========
+@st.cache_resource(show_spinner=False)
+def _store():
+    # One store per server process, shared by every page and session
+    return {"mat": None, "names": [], "display_info": [], "index": None, "sig": None, "lock": threading.Lock()}
+
+def _signature():
+    # (file count, newest mtime) of the encodings directory; adds, removals and re-saves all change it
+    if not os.path.isdir(ENCODING_DIR):
+        return (0, 0)
+    entries = list(os.scandir(ENCODING_DIR))
+    return (len(entries), max((e.stat().st_mtime for e in entries), default=0))
+
+def build_index(known_matrix):
+    # Exact L2 index over the encodings (search returns squared distances); None without faiss or encodings
+    if faiss is None or len(known_matrix) == 0:
+        return None
+    index = faiss.IndexFlatL2(known_matrix.shape[1])
+    index.add(np.ascontiguousarray(known_matrix, dtype=np.float32))
+    return index
+
+def _refresh(store):
+    # Reload everything derived from the encodings directory if it changed; caller holds the lock
+    if store["sig"] != _signature():
+        os.makedirs(ENCODING_DIR, exist_ok=True)
+        store["mat"], store["names"], store["display_info"] = load_known_faces()
+        store["index"] = build_index(store["mat"])
+        # Taken after loading, which may have rebuilt encodings.bin / names.json; a registration that lands
+        # meanwhile still calls invalidate() once it is done
+        store["sig"] = _signature()
+
+def get_known_faces():
+    """Return (known_matrix, known_names, display_info, index) from one consistent load.
+    index is the faiss index over known_matrix, or None when faiss is not installed.
+    """
+    store = _store()
+    with store["lock"]:
+        _refresh(store)
+        return store["mat"], store["names"], store["display_info"], store["index"]
+
+def invalidate():
+    """Force the next get_known_faces() call to reload from disk."""
+    store = _store()
+    with store["lock"]:
+        store["sig"] = None
+
+
+# ========== Saving ==========
+def update_packed_encodings(folder_name, new_encodings):
+    """Append new rows to encodings.bin / names.json after a student's .npy file was saved.
+    Both files are rebuilt from the .npy files if they are missing, out of sync or stale.
+    """
+    names = _load_packed_names(just_saved=folder_name)
+    if names is None:
+        rebuild_packed_encodings()
+        return
+
+    with open(PACKED_ENCODINGS_PATH, "ab") as f:
+        np.asarray(new_encodings, dtype=np.float32).tofile(f)
+    names.extend([folder_name] * len(new_encodings))
+    with open(PACKED_NAMES_PATH, "w") as f:
+        json.dump(names, f)
@@ -2,8 +2,11 @@
 # Author: Ahmad Kraiem
 
 import streamlit as st
+import encodings_store  # before dlib, so its BLAS thread defaults are in place when dlib loads
+import attendance_db
 import cv2
 import os
+import dlib
 import face_recognition
 import numpy as np
 import sqlite3
@@ -11,6 +14,12 @@ import smtplib
 from email.message import EmailMessage
 from datetime import datetime, date, timedelta
 import pandas as pd
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import av
+from streamlit_webrtc import webrtc_streamer, WebRtcMode, VideoProcessorBase
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -23,25 +32,60 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 
 # Paths
 DB_PATH = os.getenv("DB_PATH", os.path.join("database", "attendance.db"))
-ENCODING_DIR = "encodings"
+
+# Recognition settings
+PROCESS_EVERY_N_FRAMES = 3  # run detection/encoding on every Nth frame, redraw last boxes otherwise
+USE_CUDA = getattr(dlib, "DLIB_USE_CUDA", False)  # GPU build: use dlib's CNN detector instead of Haar
+
+# ========== Database Connection ==========
+@st.cache_resource(show_spinner=False)
+def get_conn():
+    """Shared autocommit connection reused across reruns; WAL keeps readers from blocking writers."""
+    os.makedirs("database", exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def get_write_lock():
+    """Process-wide lock for writes on the shared connection (the page script re-runs, so it must live in the cache)."""
+    return threading.Lock()
+
+@contextmanager
+def write_transaction(begin="BEGIN"):
+    """Run the block as one transaction on the shared connection, one session at a time.
+    Rolls back on any error so the connection is never left inside an open transaction.
+    """
+    conn = get_conn()
+    with get_write_lock():
+        c = conn.cursor()
+        c.execute(begin)
+        try:
+            yield c
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
 
 # ========== Initialize DB ==========
 def init_db():
-    os.makedirs("database", exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS attendance (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            full_name TEXT NOT NULL,
-            reg_no TEXT NOT NULL,
-            date TEXT NOT NULL,
-            time TEXT NOT NULL,
-            status TEXT NOT NULL
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with write_transaction() as c:
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS attendance (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                full_name TEXT NOT NULL,
+                reg_no TEXT NOT NULL,
+                date TEXT NOT NULL,
+                time TEXT NOT NULL,
+                status TEXT NOT NULL,
+                time_s INTEGER
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_att_date_name ON attendance (date, full_name)")
+    with get_write_lock():
+        attendance_db.ensure_time_s_column(get_conn())  # older databases predate the time_s column
 
 init_db()
 
@@ -80,42 +124,122 @@ Attendance System"""
 
 
 # ========== Attendance Logic ==========
+def load_marked_today():
+    """Names with any attendance row today; seeds the in-memory dedup set for a camera session."""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT full_name FROM attendance WHERE date = ?", (date.today().isoformat(),))
+    names = {row[0] for row in c.fetchall()}
+    return names
+
 def mark_attendance(full_name, reg_no):
+    marked_today = st.session_state.setdefault("marked_today", set())
+    if full_name in marked_today:
+        return
     today = date.today().isoformat()
-    now = datetime.now().strftime("%H:%M:%S")
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM attendance WHERE full_name = ? AND date = ?", (full_name, today))
-    if not c.fetchone():
-        c.execute("INSERT INTO attendance (full_name, reg_no, date, time, status) VALUES (?, ?, ?, ?, ?)",
-                  (full_name, reg_no, today, now, "Present"))
-        conn.commit()
-        st.toast(f"✅ Attendance marked for {full_name}")
+    now_dt = datetime.now()
+    now = now_dt.strftime("%H:%M:%S")
+    now_s = now_dt.hour * 3600 + now_dt.minute * 60 + now_dt.second
+    with write_transaction() as c:
+        c.execute("SELECT 1 FROM attendance WHERE date = ? AND full_name = ? LIMIT 1", (today, full_name))
+        inserted = c.fetchone() is None
+        if inserted:
+            c.execute("INSERT INTO attendance (full_name, reg_no, date, time, status, time_s) VALUES (?, ?, ?, ?, ?, ?)",
+                      (full_name, reg_no, today, now, "Present", now_s))
+    marked_today.add(full_name)
+    if inserted:
+        # Email first: a pending rerun is raised at the first st.* call, which must not come between insert and send
         send_attendance_email(full_name, reg_no)
-    conn.close()
-
-# ========== Load Encodings ==========
-def load_known_faces():
-    known_encodings = []
-    known_names = []
-    reg_map = {}
-    for file in os.listdir(ENCODING_DIR):
-        if file.endswith(".npy"):
-            name_with_reg = file.replace(".npy", "")
-            encs = np.load(os.path.join(ENCODING_DIR, file), allow_pickle=True)
-            for enc in encs:
-                known_encodings.append(enc)
-                known_names.append(name_with_reg)
-                name_part, reg_no = name_with_reg.rsplit("_", 1)
-                full_name = name_part.replace("_", " ").strip().lower()
-                reg_map[full_name] = reg_no
-    return known_encodings, known_names, reg_map
+        st.toast(f"✅ Attendance marked for {full_name}")
+
+# ========== Video Processing ==========
+class FaceProcessor(VideoProcessorBase):
+    """Recognizes faces on the WebRTC worker thread.
+    Newly recognized names are queued for the script thread, which owns the database, toasts and emails.
+    """
+
+    def __init__(self, known_matrix, display_info, index=None):
+        self.known_matrix = known_matrix
+        self.known_sq_norms = np.einsum("ij,ij->i", known_matrix, known_matrix)
+        self.index = index
+        self.display_info = display_info
+        self.detector = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        self.frame_idx = 0
+        self.last_detections = []  # (label, box) pairs redrawn on frames that skip recognition
+        self.seen = set()
+        self.recognized = queue.Queue()
+        if USE_CUDA:
+            # Pay CUDA context and model initialization now rather than on the first real frame
+            blank = np.zeros((120, 160, 3), dtype=np.uint8)
+            face_recognition.face_locations(blank, model="cnn")
+            face_recognition.face_encodings(blank, [(20, 120, 100, 40)])
+
+    def detect(self, img):
+        # Face boxes (top, right, bottom, left) at full resolution, found on a 1/4-scale frame
+        small = cv2.resize(img, (0, 0), fx=0.25, fy=0.25)
+        if USE_CUDA:
+            boxes = face_recognition.face_locations(cv2.cvtColor(small, cv2.COLOR_BGR2RGB), model="cnn")
+        else:
+            # Haar is a cheap CPU gate for the expensive encoder
+            faces = self.detector.detectMultiScale(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), 1.3, 5)
+            boxes = [(y, x + w, y + h, x) for (x, y, w, h) in faces]
+        return [(top * 4, right * 4, bottom * 4, left * 4) for (top, right, bottom, left) in boxes]
+
+    def match(self, face_encodings):
+        # (best row, L2 distance) for each encoding, via the faiss index when available
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, 128)
+        if self.index is not None:
+            sq_distances, rows = self.index.search(queries, 1)
+            return [(int(row[0]), float(np.sqrt(max(0.0, d[0])))) for d, row in zip(sq_distances, rows)]
+        matches = []
+        for query in queries:
+            # ||k - q||^2 = ||k||^2 - 2 k.q + ||q||^2, computed for all known faces at once
+            sq_distances = self.known_sq_norms - 2 * (self.known_matrix @ query)
+            best_match_index = int(np.argmin(sq_distances))
+            matches.append((best_match_index, float(np.sqrt(max(0.0, sq_distances[best_match_index] + query @ query)))))
+        return matches
+
+    def recv(self, frame):
+        img = frame.to_ndarray(format="bgr24")
+
+        if self.frame_idx % PROCESS_EVERY_N_FRAMES == 0:
+            self.last_detections = []
+            face_locations = self.detect(img)
+            if face_locations:
+                rgb_frame = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+            else:
+                face_encodings = []
+
+            matches = self.match(face_encodings) if face_encodings else []
+            for (best_match_index, best_distance), box in zip(matches, face_locations):
+                if best_distance < 0.4:
+                    info = self.display_info[best_match_index]
+                    name = info[0]
+                    if name not in self.seen:
+                        self.seen.add(name)
+                        self.recognized.put(info)
+                    label = f"{name} ({round((1 - best_distance) * 100)}%)"
+                else:
+                    label = "Unknown"
+                self.last_detections.append((label, box))
+        self.frame_idx += 1
+
+        for label, (top, right, bottom, left) in self.last_detections:
+            cv2.putText(img, label, (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+            cv2.rectangle(img, (left, top), (right, bottom), (255, 0, 0), 2)
+
+        return av.VideoFrame.from_ndarray(img, format="bgr24")
 
 # ========== UI Layout ==========
 st.set_page_config(page_title="Capture Attendance", page_icon="🎥", layout="wide", initial_sidebar_state="expanded")
 st.title("🎥 Capture Attendance")
 st.markdown("Use this page to recognize students and log attendance automatically.")
 
+if not getattr(dlib, "DLIB_USE_BLAS", False):
+    st.warning("⚠️ dlib was built without BLAS, so face recognition will be slow. "
+               "Install OpenBLAS (e.g. libopenblas-dev) and reinstall dlib for a 10-25x speedup.")
+
 main_cols = st.columns([2, 1], gap="large")
 
 if "recognized_names" not in st.session_state:
@@ -124,92 +248,66 @@ if "camera_running" not in st.session_state:
     st.session_state.camera_running = False
 if "camera_stopped" not in st.session_state:
     st.session_state.camera_stopped = False
+if "camera_timer_expired" not in st.session_state:
+    st.session_state.camera_timer_expired = False
 
 with main_cols[0]:
     st.subheader("Camera Feed")
-    st.caption("ℹ️ Press ESC to stop the camera when the window opens.")
+    st.caption("ℹ️ Press START to open the camera in the browser and STOP to end the session.")
 
     use_timer = st.checkbox("⏱️ Use Timer", value=False)
     duration_minutes = st.slider("Select camera duration (minutes):", 1, 180, 10) if use_timer else 1
 
-    camera_index = st.selectbox(
-        "Select Camera",
-        options=[0, 1],
-        format_func=lambda x: "📷 Built-in (0)" if x == 0 else "🔌 External (1)"
-    )
-
-    start_btn = st.button("Start Camera", type="primary")
+    known_matrix, _, display_info, known_index = encodings_store.get_known_faces()
+    webrtc_ctx = None
+    if len(known_matrix) == 0:
+        st.error("No known encodings found. Register students first.")
+    else:
+        webrtc_ctx = webrtc_streamer(
+            key="capture",
+            mode=WebRtcMode.SENDRECV,
+            video_processor_factory=lambda: FaceProcessor(known_matrix, display_info, known_index),
+            # 640x480 keeps decode, color conversion and detection cost low; the browser picks the closest mode
+            media_stream_constraints={"video": {"width": {"ideal": 640}, "height": {"ideal": 480}}, "audio": False},
+            desired_playing_state=False if st.session_state.camera_timer_expired else None,
+            async_processing=True
+        )
+        st.session_state.camera_timer_expired = False
 
-    if start_btn:
-        known_encodings, known_names, reg_map = load_known_faces()
-        if not known_encodings:
-            st.error("No known encodings found. Register students first.")
-        else:
+        if webrtc_ctx.state.playing and not st.session_state.camera_running:
+            # A new camera session has started
             st.session_state.recognized_names = []
+            st.session_state.marked_today = load_marked_today()
             st.session_state.camera_running = True
             st.session_state.camera_stopped = False
-
-            cam = cv2.VideoCapture(camera_index)
-            start_time = datetime.now()
-            end_time = start_time + timedelta(minutes=duration_minutes) if use_timer else None
-
-            while True:
-                ret, frame = cam.read()
-                if not ret:
-                    st.error("❌ Failed to access camera.")
-                    break
-
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                face_locations = face_recognition.face_locations(rgb_frame)
-                face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
-
-                for face_encoding, (top, right, bottom, left) in zip(face_encodings, face_locations):
-                    distances = face_recognition.face_distance(known_encodings, face_encoding)
-                    best_match_index = np.argmin(distances)
-                    if distances[best_match_index] < 0.4:
-                        name_with_reg = known_names[best_match_index]
-                        name = name_with_reg.replace("_", " ").rsplit(" ", 1)[0].title()
-                        if name not in st.session_state.recognized_names:
-                            st.session_state.recognized_names.append(name)
-                            full_name = name.lower()
-                            reg_no = reg_map.get(full_name, "UNKNOWN")
-                            mark_attendance(full_name, reg_no)
-                        label = f"{name} ({round((1 - distances[best_match_index]) * 100)}%)"
-                    else:
-                        label = "Unknown"
-
-                    cv2.putText(frame, label, (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-                    cv2.rectangle(frame, (left, top), (right, bottom), (255, 0, 0), 2)
-
-                cv2.imshow("Face Recognition Attendance", frame)
-
-                if cv2.waitKey(1) & 0xFF == 27:
-                    st.info("🛑 Camera stopped manually (ESC).")
-                    break
-                if use_timer and datetime.now() >= end_time:
-                    st.info("⏱️ Timer ended. Camera stopped automatically.")
-                    break
-
-            cam.release()
-            cv2.destroyAllWindows()
+            st.session_state.camera_end_time = datetime.now() + timedelta(minutes=duration_minutes) if use_timer else None
+        elif not webrtc_ctx.state.playing and st.session_state.camera_running:
             st.session_state.camera_running = False
             st.session_state.camera_stopped = True
 
     if st.session_state.camera_running:
-        st.warning(f"🔍 Camera is running for {duration_minutes} minute(s)...")
+        if st.session_state.get("camera_end_time"):
+            st.warning(f"🔍 Camera is running for {duration_minutes} minute(s)...")
+        else:
+            st.warning("🔍 Camera is running...")
     elif st.session_state.camera_stopped:
         st.success("✅ Camera has been stopped.")
     else:
         st.info("Camera is off.")
 
+def render_recognition_status(container):
+    with container.container():
+        if st.session_state.recognized_names:
+            st.success("Recognized and marked present:")
+            for name in st.session_state.recognized_names:
+                st.write(f"✅ {name}")
+        else:
+            st.warning("No face detected.")
+
 with main_cols[1]:
     st.subheader("Recognition Status")
-    if st.session_state.recognized_names:
-        st.success("Recognized and marked present:")
-        for name in st.session_state.recognized_names:
-            st.write(f"✅ {name}")
-    else:
-        st.warning("No face detected.")
+    recognition_box = st.empty()
+    render_recognition_status(recognition_box)
 
     st.divider()
     st.subheader("Actions")
@@ -217,36 +315,35 @@ with main_cols[1]:
     if st.button("📊 View Today’s Attendance Report"):
         today = date.today().isoformat()
 
-        def get_registered_students():
-            conn = sqlite3.connect(DB_PATH)
+        @st.cache_data(show_spinner=False, max_entries=1)
+        def get_registered_students(db_sig):
+            conn = get_conn()
             df = pd.read_sql_query("SELECT full_name FROM students", conn)
-            conn.close()
             return sorted(df["full_name"].tolist())
 
         def get_today_present():
-            conn = sqlite3.connect(DB_PATH)
+            conn = get_conn()
             c = conn.cursor()
             c.execute("SELECT DISTINCT full_name FROM attendance WHERE date = ? AND status = 'Present'", (today,))
             rows = c.fetchall()
-            conn.close()
             return sorted([row[0] for row in rows])
 
-        all_students = get_registered_students()
+        all_students = get_registered_students(attendance_db.db_signature(DB_PATH))
         present_today = get_today_present()
         absent_students = sorted(list(set(all_students) - set(present_today)))
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        for name in absent_students:
-            c.execute("SELECT * FROM attendance WHERE full_name = ? AND date = ?", (name, today))
-            if not c.fetchone():
-                c.execute("SELECT reg_no FROM students WHERE full_name = ?", (name,))
-                reg_result = c.fetchone()
-                reg_no = reg_result[0] if reg_result else "UNKNOWN"
-                c.execute("INSERT INTO attendance (full_name, reg_no, date, time, status) VALUES (?, ?, ?, ?, ?)",
-                          (name, reg_no, today, "-", "Absent"))
-        conn.commit()
-        conn.close()
+        # Mark absentees in one transaction: two lookups up front, then a single batched insert
+        with write_transaction("BEGIN IMMEDIATE") as c:
+            c.execute("SELECT DISTINCT full_name FROM attendance WHERE date = ?", (today,))
+            already_logged = {row[0] for row in c.fetchall()}
+            reg_lookup = {}
+            for name, reg_no in c.execute("SELECT full_name, reg_no FROM students"):
+                reg_lookup.setdefault(name, reg_no)
+            c.executemany(
+                "INSERT INTO attendance (full_name, reg_no, date, time, status) VALUES (?, ?, ?, ?, ?)",
+                [(name, reg_lookup.get(name, "UNKNOWN"), today, "-", "Absent")
+                 for name in absent_students if name not in already_logged]
+            )
 
         total = len(all_students)
         present = len(present_today)
@@ -269,44 +366,79 @@ with main_cols[1]:
 st.divider()
 st.subheader("🗜️ Modify Today's Attendance Status")
 
-def get_today_attendance():
-    today = date.today().isoformat()
-    conn = sqlite3.connect(DB_PATH)
+@st.cache_data(show_spinner=False, max_entries=1)
+def get_today_attendance(today, db_sig):
+    conn = get_conn()
     df = pd.read_sql_query(
         "SELECT id, full_name, reg_no, time, status FROM attendance WHERE date = ?", conn,
         params=(today,)
     )
-    conn.close()
     return df
 
-def toggle_status(record_id, current_status):
-    new_status = "Absent" if current_status == "Present" else "Present"
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE attendance SET status = ? WHERE id = ?", (new_status, record_id))
-    conn.commit()
-    conn.close()
+def update_statuses(changed_df):
+    # Write all edited statuses in one transaction
+    with write_transaction() as c:
+        c.executemany(
+            "UPDATE attendance SET status = ? WHERE id = ?",
+            [(status, int(record_id)) for record_id, status in zip(changed_df["id"], changed_df["status"])]
+        )
+    get_today_attendance.clear()
     st.session_state.force_reload = True
     st.rerun()
 
-attendance_df = get_today_attendance()
+attendance_df = get_today_attendance(date.today().isoformat(), attendance_db.db_signature(DB_PATH))
 if attendance_df.empty:
     st.info("No attendance records found for today.")
 else:
-    for idx, row in attendance_df.iterrows():
-        col1, col2, col3, col4 = st.columns([3, 2, 2, 2])
-        with col1:
-            st.write(f"👤 {row['full_name']} ({row['reg_no']})")
-        with col2:
-            st.write(f"🕒 {row['time']}")
-        with col3:
-            st.write(f"📌 Status: {row['status']}")
-        with col4:
-            if st.button(
-                f"Toggle to {'Absent' if row['status']=='Present' else 'Present'}",
-                key=f"toggle_{row['id']}"
-            ):
-                toggle_status(row['id'], row['status'])
+    edited_df = st.data_editor(
+        attendance_df,
+        column_order=["full_name", "reg_no", "time", "status"],
+        column_config={
+            "full_name": st.column_config.TextColumn("👤 Name"),
+            "reg_no": st.column_config.TextColumn("Reg. No"),
+            "time": st.column_config.TextColumn("🕒 Time"),
+            "status": st.column_config.SelectboxColumn("📌 Status", options=["Present", "Absent"], required=True),
+        },
+        disabled=["full_name", "reg_no", "time"],
+        hide_index=True,
+        use_container_width=True,
+        key="today_status_editor"
+    )
+    changed_df = edited_df[edited_df["status"] != attendance_df["status"]]
+    if st.button(f"💾 Save Status Changes ({len(changed_df)})", disabled=changed_df.empty):
+        update_statuses(changed_df)
 
 # ========== Footer ==========
-st.caption("Attendance is now marked automatically upon face recognition.")
\ No newline at end of file
+st.caption("Attendance is now marked automatically upon face recognition.")
+
+# ========== Recognition Results ==========
+# Runs last so the whole page is already rendered; any widget interaction reruns the script and restarts this loop.
+if webrtc_ctx is not None and webrtc_ctx.state.playing:
+    heartbeat = st.empty()
+    seen_processor = False
+    while webrtc_ctx.state.playing:
+        # Streamlit only acts on STOP, reruns and closed tabs when the script sends output, so send some every pass
+        heartbeat.empty()
+        processor = webrtc_ctx.video_processor  # may still be None for a moment after START
+        info = None
+        if processor is None:
+            if seen_processor:
+                break  # the video worker has shut down
+            time.sleep(0.5)
+        else:
+            seen_processor = True
+            try:
+                info = processor.recognized.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        if info and info[0] not in st.session_state.recognized_names:
+            name, full_name, reg_no = info
+            st.session_state.recognized_names.append(name)
+            mark_attendance(full_name, reg_no)
+            render_recognition_status(recognition_box)
+        end_time = st.session_state.get("camera_end_time")
+        if end_time and datetime.now() >= end_time:
+            st.session_state.camera_end_time = None
+            st.session_state.camera_timer_expired = True
+            st.toast("⏱️ Timer ended. Camera stopped automatically.")
+            st.rerun()
@@ -3,6 +3,8 @@
 
 # ========== Imports ==========
 import streamlit as st
+import encodings_store  # before face_recognition, so its BLAS thread defaults are in place when dlib loads
+import attendance_db
 import cv2
 import os
 import numpy as np
@@ -11,10 +13,16 @@ import face_recognition
 from datetime import date
 import sqlite3
 
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:  # numba is optional; the blur check falls back to OpenCV
+    NUMBA_AVAILABLE = False
+
 # ========== Paths ==========
 DB_PATH = os.path.join("database", "attendance.db")
 DATASET_DIR = "dataset"
-ENCODING_DIR = "encodings"
+ENCODING_DIR = encodings_store.ENCODING_DIR
 os.makedirs("database", exist_ok=True)
 os.makedirs(DATASET_DIR, exist_ok=True)
 os.makedirs(ENCODING_DIR, exist_ok=True)
@@ -50,6 +58,33 @@ def normalize_folder_name(name: str, reg_no: str) -> str:
     reg_no = reg_no.strip().lower()
     return f"{name}_{reg_no}"
 
+if NUMBA_AVAILABLE:
+    @njit(cache=True, fastmath=True, parallel=True)
+    def laplacian_var(gray):
+        # Variance of the 3x3 Laplacian (same kernel and reflect-101 border as cv2.Laplacian)
+        h, w = gray.shape
+        total = 0.0
+        total_sq = 0.0
+        for y in prange(h):
+            up = y - 1 if y > 0 else 1
+            down = y + 1 if y < h - 1 else h - 2
+            for x in range(w):
+                left = x - 1 if x > 0 else 1
+                right = x + 1 if x < w - 1 else w - 2
+                v = (np.int32(gray[up, x]) + np.int32(gray[down, x]) + np.int32(gray[y, left])
+                     + np.int32(gray[y, right]) - 4 * np.int32(gray[y, x]))
+                total += v
+                total_sq += v * v
+        n = h * w
+        mean = total / n
+        return total_sq / n - mean * mean
+else:
+    def laplacian_var(gray):
+        # Variance of the 3x3 Laplacian, used as a blur score; uint8 input fits in a 16-bit output buffer
+        lap = cv2.Laplacian(gray, cv2.CV_16S)
+        _, std = cv2.meanStdDev(lap)
+        return std[0, 0] * std[0, 0]
+
 # ========== Input Form ==========
 form_cols = st.columns([1, 1, 2], gap="large") # Create input form columns
 
@@ -102,6 +137,10 @@ with form_cols[2]:
         if st.button("📸 Capture Images and Register", type="primary"): # Start capture on button click
             os.makedirs(folder_path, exist_ok=True)
             cam = cv2.VideoCapture(camera_index)  # ✅ Use selected camera
+            cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG')) # Compressed USB transfer instead of raw YUY2
+            cam.set(cv2.CAP_PROP_FRAME_WIDTH, 640) # Lower resolution is enough for face capture
+            cam.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            cam.set(cv2.CAP_PROP_BUFFERSIZE, 1) # Always read the most recent frame
             detector = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml') # Face detector
             # Initialize counters
             total_attempts = 0
@@ -133,9 +172,9 @@ with form_cols[2]:
                     else:
                         (x, y, w, h) = faces[0] # Take first face only
                         face = frame[y:y+h, x:x+w] # Crop the face
-                        laplacian_var = cv2.Laplacian(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()  # Blur detection
+                        blur_score = laplacian_var(gray[y:y+h, x:x+w]) # Blur detection on the already-converted gray crop
 
-                        if laplacian_var < 100:
+                        if blur_score < 100:
                             rejected_blur += 1 # Image is blurry
                             alert_container.warning("⚠️ Image too blurry. Please hold still.")
                         else:
@@ -159,10 +198,13 @@ with form_cols[2]:
                 cv2.destroyAllWindows() # Close window
 
             if encodings:
+                new_encodings = encodings
                 if os.path.exists(encoding_path):
                     old_encodings = list(np.load(encoding_path, allow_pickle=True)) # Load existing encodings
                     encodings = old_encodings + encodings
                 np.save(encoding_path, encodings) # Save updated encodings
+                encodings_store.update_packed_encodings(folder_name, new_encodings) # Keep the packed copy in sync
+                encodings_store.invalidate() # Capture Attendance reloads the known faces on its next run
 
                 conn = sqlite3.connect(DB_PATH)
                 c = conn.cursor()
@@ -213,7 +255,8 @@ if "capture_stats" in st.session_state:
 st.divider()
 st.subheader("📋 Registered Students")
 
-def get_registered_students():
+@st.cache_data(show_spinner=False, max_entries=1)
+def get_registered_students(db_sig):
     # Fetch all students from DB
     conn = sqlite3.connect(DB_PATH)
     df = pd.read_sql_query("""
@@ -226,7 +269,7 @@ def get_registered_students():
     conn.close()
     return df
 
-df = get_registered_students()
+df = get_registered_students(attendance_db.db_signature(DB_PATH))
 if df.empty:
     st.info("No students registered yet.") # No data yet
 else:
@@ -5,10 +5,16 @@
 # ========== Imports ==========
 import streamlit as st
 import pandas as pd
+import numpy as np
 import sqlite3
 import os
+import time
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
+import altair as alt
+import attendance_db
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from pandas.api.types import is_datetime64_any_dtype
 
 # ========== Page Config ==========
 st.set_page_config(
@@ -43,27 +49,42 @@ if st.button("🔄 Refresh Data", type="primary"):
 # ========== Load Data ==========
 DB_PATH = "database/attendance.db"
 
+def get_db():
+    # One connection per browser session; autocommit mode so the save path controls its own transaction
+    if "db" not in st.session_state:
+        st.session_state.db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        st.session_state.db.execute("PRAGMA journal_mode=WAL")
+        st.session_state.db.execute("PRAGMA synchronous=NORMAL")
+    return st.session_state.db
+
+def times_to_seconds(times):
+    # "HH:MM:SS" column -> seconds since midnight as Python ints, None for "-" or anything unparsable
+    seconds = pd.to_timedelta(times.where(times.str.fullmatch(r"\d{1,2}:\d{1,2}:\d{1,2}", na=False)), errors="coerce")
+    return seconds.dt.total_seconds().astype("Int64").to_numpy(dtype=object, na_value=None)
+
 @st.cache_data
 def load_data():
     if not os.path.exists(DB_PATH):
-        return pd.DataFrame(columns=["id", "Date", "Full Name", "Reg. No", "Time", "Status"])
-    conn = sqlite3.connect(DB_PATH)
+        return pd.DataFrame(columns=["id", "Date", "Full Name", "Reg. No", "Time", "Status", "time_s"]), time.time()
+    conn = get_db()
+    attendance_db.ensure_time_s_column(conn)
     df = pd.read_sql_query("""
-        SELECT id, date AS Date, full_name AS 'Full Name', reg_no AS 'Reg. No', time AS Time, status AS Status 
+        SELECT id, date AS Date, full_name AS 'Full Name', reg_no AS 'Reg. No', time AS Time, status AS Status, time_s
         FROM attendance
     """, conn)
-    conn.close()
     df["Date"] = pd.to_datetime(df["Date"])
-    return df
+    return df, time.time()
 
-df = load_data()
+# data_version changes whenever load_data() actually reloads; it keys the per-filter caches below
+df, data_version = load_data()
 
+# Snapshot indexed by id, so the save path gathers the visible rows by label instead of scanning with isin
 if "force_reload" in st.session_state and st.session_state.force_reload:
-    st.session_state.original_data = df.copy()
+    st.session_state.original_data = df.set_index("id", drop=False)
     st.session_state.force_reload = False
 
 if st.session_state.original_data is None:
-    st.session_state.original_data = df.copy()
+    st.session_state.original_data = df.set_index("id", drop=False)
 
 # ========== Filters ==========
 st.subheader("🔍 Filter Options")
@@ -100,32 +121,86 @@ if selected_date != "All":
 if selected_name != "All":
     filtered_df = filtered_df[filtered_df["Full Name"] == selected_name]
 
-filtered_df["Date"] = filtered_df["Date"].dt.date
+# Everything that decides which rows are in filtered_df; the relative ranges move with the calendar day
+filter_key = (data_version, time_filter, selected_date, selected_name, today.date())
+
+# ========== Cached Computations ==========
+# Keyed on filter_key, with the frame passed as an unhashed _df argument: hashing the whole frame on every
+# rerun costs more than the aggregations it would let us skip.
+@st.cache_data(show_spinner=False, max_entries=16)
+def compute_aggregates(filter_key, _df):
+    # Category codes make the groupbys and "Present" comparisons integer work; the editor keeps plain strings
+    df = _df.astype({"Status": "category", "Full Name": "category", "Reg. No": "category"})
+    present = df["Status"] == "Present"
+    timed = df["Time"] != "-"
+
+    valid_times = df.loc[timed, "Time"]
+    valid_seconds = df.loc[timed, "time_s"].dropna()
+    if valid_times.empty:
+        earliest = latest = avg_time_str = "N/A"
+    else:
+        earliest = valid_times.min()
+        latest = valid_times.max()
+        if not valid_seconds.empty:
+            mean_s = int(valid_seconds.mean())
+            avg_time_str = f"{mean_s // 3600:02d}:{(mean_s % 3600) // 60:02d}:{mean_s % 60:02d}"
+        else:
+            avg_time_str = "N/A"
+
+    status_counts = df.groupby(["Date", "Status"], observed=True).size().unstack(fill_value=0)
+    status_counts = status_counts.reindex(columns=["Present", "Absent"], fill_value=0)
+
+    top_present = df.loc[present, "Full Name"].value_counts()
+    top_present = top_present[top_present > 0].head(10)  # categorical value_counts also lists unused names
+
+    present_seconds = df.loc[present & timed, "time_s"].dropna().to_numpy()
+
+    return {
+        "total_records": len(df),
+        "unique_students": df["Full Name"].nunique(),
+        "earliest": earliest,
+        "latest": latest,
+        "avg_time_str": avg_time_str,
+        "status_counts": status_counts,
+        "top_present": top_present.rename_axis("Student").reset_index(name="Present Count"),
+        "time_hours": (present_seconds // 60) / 60.0,  # hour + minute / 60, straight from the stored seconds
+    }
+
+# The breakdown, top-days and daily-comparison charts all read the one cached (Date, Status) count table
+def top_present_days(status_counts, n=7):
+    present = status_counts["Present"]
+    return present[present > 0].nlargest(n)
+
+def fill_daily_range(status_counts):
+    # Scatter the per-day counts onto every day in range by day ordinal, so gaps show up as zero days
+    if status_counts.empty:
+        return status_counts
+    day_nums = status_counts.index.to_numpy().astype("datetime64[D]").astype(np.int64)
+    first_day = day_nums.min()
+    n_days = int(day_nums.max() - first_day) + 1
+    daily_counts = np.zeros((n_days, 2), dtype=np.int64)
+    daily_counts[day_nums - first_day] = status_counts.to_numpy()
+
+    full_range = pd.DatetimeIndex((first_day + np.arange(n_days)).astype("datetime64[D]"))
+    return pd.DataFrame(daily_counts, index=full_range, columns=["Present", "Absent"])
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def encode_csv(filter_key, _df):
+    # pyarrow's multithreaded CSV writer (pyarrow ships with Streamlit); cached, so only reruns with new filters pay for it
+    sink = pa.BufferOutputStream()
+    pacsv.write_csv(pa.Table.from_pandas(_df.drop(columns="time_s"), preserve_index=False), sink)
+    return sink.getvalue().to_pybytes()
+
+aggregates = compute_aggregates(filter_key, filtered_df)
 
 # ========== Stats ==========
 st.subheader("📈 Attendance Summary")
-total_records = len(filtered_df)
-unique_students = filtered_df["Full Name"].nunique()
-valid_times = filtered_df[filtered_df["Time"] != "-"]["Time"]
-
-if not valid_times.empty:
-    earliest = valid_times.min()
-    latest = valid_times.max()
-    try:
-        times_dt = pd.to_datetime(valid_times, format="%H:%M:%S")
-        avg_time = (times_dt - pd.Timestamp("1900-01-01")).mean() + pd.Timestamp("1900-01-01")
-        avg_time_str = avg_time.strftime("%H:%M:%S")
-    except:
-        avg_time_str = "N/A"
-else:
-    earliest = latest = avg_time_str = "N/A"
-
 col1, col2, col3, col4, col5 = st.columns(5)
-col1.metric("📄 Total Records", total_records)
-col2.metric("👥 Unique Students", unique_students)
-col3.metric("🕐 Earliest", earliest)
-col4.metric("🕓 Latest", latest)
-col5.metric("⏱ Average Time", avg_time_str)
+col1.metric("📄 Total Records", aggregates["total_records"])
+col2.metric("👥 Unique Students", aggregates["unique_students"])
+col3.metric("🕐 Earliest", aggregates["earliest"])
+col4.metric("🕓 Latest", aggregates["latest"])
+col5.metric("⏱ Average Time", aggregates["avg_time_str"])
 
 # ========== Charts Toggle ==========
 st.session_state.show_charts = st.toggle("📊 Show Visual Charts", value=st.session_state.show_charts)
@@ -137,85 +212,50 @@ if st.session_state.show_charts and not filtered_df.empty:
 
     with row1_col1:
         st.caption("📅 Attendance Breakdown by Day")
-        status_counts = filtered_df.groupby(["Date", "Status"]).size().unstack(fill_value=0)
-        for status in ["Present", "Absent"]:
-            if status not in status_counts.columns:
-                status_counts[status] = 0
-        fig1, ax1 = plt.subplots()
-        status_counts[["Present", "Absent"]].plot(kind="bar", ax=ax1, color=["#4e79a7", "#e15759"])
-        ax1.set_xlabel("Date")
-        ax1.set_ylabel("Count")
-        ax1.set_title("Attendance by Day")
-        plt.xticks(rotation=45)
-        st.pyplot(fig1)
+        status_counts = aggregates["status_counts"]
+        st.bar_chart(status_counts, color=["#4e79a7", "#e15759"])
 
     with row1_col2:
         st.caption("🏆 Top Attendees (Present Only)")
-        top_present = filtered_df[filtered_df["Status"] == "Present"]["Full Name"].value_counts().head(10)
-        fig2, ax2 = plt.subplots()
-        ax2.barh(top_present.index[::-1], top_present.values[::-1], color="#59a14f")
-        ax2.set_xlabel("Present Count")
-        ax2.set_ylabel("Student")
-        ax2.set_title("Top Present Students")
-        st.pyplot(fig2)
+        top_chart = alt.Chart(aggregates["top_present"]).mark_bar(color="#59a14f").encode(
+            x="Present Count:Q",
+            y=alt.Y("Student:N", sort="-x")
+        )
+        st.altair_chart(top_chart, use_container_width=True)
 
     with row1_col3:
         st.caption("⏳ Time of Day Distribution (Present Only)")
-        try:
-            valid_times = filtered_df[(filtered_df["Status"] == "Present") & (filtered_df["Time"] != "-")]["Time"]
-            time_series = pd.to_datetime(valid_times, format="%H:%M:%S")
-            time_hours = time_series.dt.hour + time_series.dt.minute / 60.0
-            fig3, ax3 = plt.subplots()
-            ax3.hist(time_hours, bins=12, color="#f28e2b", edgecolor="black")
-            ax3.set_xlabel("Hour")
-            ax3.set_ylabel("Count")
-            ax3.set_title("Time Distribution")
-            st.pyplot(fig3)
-        except:
-            st.warning("⚠️ Time format error")
+        time_hours = aggregates["time_hours"]
+        if time_hours.size:
+            hist_counts, hist_edges = np.histogram(time_hours, bins=12)
+            hist_df = pd.DataFrame({"Count": hist_counts}, index=pd.Index(np.round(hist_edges[:-1], 2), name="Hour"))
+            st.bar_chart(hist_df, color="#f28e2b")
+        else:
+            st.info("No check-in times to plot.")
 
     row2_col1, row2_col2, _ = st.columns([1, 1, 1])
 
     with row2_col1:
         st.caption("📆 Top Attendance Days (Present Only)")
-        top_days_present = (
-            filtered_df[filtered_df["Status"] == "Present"]
-            .groupby("Date").size()
-            .sort_values(ascending=False).head(7)
+        top_days_present = top_present_days(status_counts)
+        top_days_df = top_days_present.rename_axis("Date").reset_index(name="Present Count")
+        top_days_df["Date"] = top_days_df["Date"].dt.strftime("%Y-%m-%d")
+        top_days_chart = alt.Chart(top_days_df).mark_bar(color="#af7aa1").encode(
+            x=alt.X("Date:N", sort="-y"),
+            y="Present Count:Q"
         )
-        fig4, ax4 = plt.subplots()
-        ax4.bar(top_days_present.index.astype(str), top_days_present.values, color="#af7aa1")
-        ax4.set_xlabel("Date")
-        ax4.set_ylabel("Present Count")
-        ax4.set_title("Top Days")
-        plt.xticks(rotation=45)
-        st.pyplot(fig4)
+        st.altair_chart(top_days_chart, use_container_width=True)
 
     with row2_col2:
         st.caption("📊 Daily Attendance Comparison")
-        try:
-            full_range = pd.date_range(start=filtered_df["Date"].min(), end=filtered_df["Date"].max())
-            daily_status = (
-                filtered_df.groupby(["Date", "Status"])
-                .size().unstack(fill_value=0)
-                .reindex(full_range, fill_value=0)
-            )
-            for status in ["Present", "Absent"]:
-                if status not in daily_status.columns:
-                    daily_status[status] = 0
-            fig5, ax5 = plt.subplots()
-            daily_status["Present"].plot(ax=ax5, marker='o', label="Present", color="#4e79a7")
-            daily_status["Absent"].plot(ax=ax5, marker='x', linestyle='--', label="Absent", color="#e15759")
-            ax5.set_xlabel("Date")
-            ax5.set_ylabel("Count")
-            ax5.set_title("Daily Comparison")
-            ax5.legend()
-            plt.xticks(rotation=45)
-            st.pyplot(fig5)
-        except:
+        daily_status = fill_daily_range(status_counts)
+        if not daily_status.empty:
+            st.line_chart(daily_status[["Present", "Absent"]], color=["#4e79a7", "#e15759"])
+        else:
             st.warning("⚠️ Could not render daily comparison chart.")
 
 # ========== Editable Table ==========
+filtered_df["Date"] = filtered_df["Date"].dt.date  # the editor and CSV show plain dates
 st.subheader("📅 Editable Attendance Table")
 if filtered_df.empty:
     st.info("No records found for the selected filters.")
@@ -223,13 +263,31 @@ else:
     editable_df = st.data_editor(
         filtered_df,
         num_rows="dynamic",
+        column_order=["id", "Date", "Full Name", "Reg. No", "Time", "Status"],
         use_container_width=True,
         key="editable_table"
     )
-    if not editable_df.equals(filtered_df):
+    # The editor reports its pending edits in session_state, so the no-edit rerun skips the comparison altogether
+    editor_state = st.session_state.get("editable_table", {})
+    has_edits = any(editor_state.get(k) for k in ("edited_rows", "added_rows", "deleted_rows"))
+    if has_edits and not editable_df.equals(filtered_df):
         st.toast("⚠️ You have made changes to the data.", icon="✏️")
         st.session_state.data_changed = True
 
+# ========== Save Helpers ==========
+EDITABLE_COLUMNS = ["Full Name", "Reg. No", "Date", "Time", "Status"]
+
+def save_params(rows):
+    # (full_name, reg_no, date, time, status, time_s) tuples for INSERT/UPDATE, built column-wise
+    return list(zip(
+        rows["Full Name"].to_numpy(),
+        rows["Reg. No"].to_numpy(),
+        rows["Date"].dt.strftime("%Y-%m-%d").to_numpy(),
+        rows["Time"].to_numpy(),
+        rows["Status"].to_numpy(),
+        times_to_seconds(rows["Time"].astype(str)),
+    ))
+
 # ========== Export & Save ==========
 st.divider()
 col_save, col_export = st.columns([1, 1], gap="small")
@@ -239,61 +297,78 @@ if "confirm_save" not in st.session_state:
 
 with col_save:
     if st.button("💾 Save Changes", use_container_width=True):
-        if st.session_state.data_changed:
-            if st.session_state.confirm_save:
-                current = editable_df.reset_index(drop=True)
-                original_all = st.session_state.original_data.reset_index(drop=True)
-                original_visible = original_all[original_all["id"].isin(filtered_df["id"])].reset_index(drop=True)
-
+        if st.session_state.data_changed and st.session_state.confirm_save:
+            # The merge below joins on the id column, so neither side needs a fresh RangeIndex copy
+            current = editable_df
+            original_all = st.session_state.original_data
+            # Ids loaded after the snapshot was taken are skipped, as isin did; they fall through as updates below
+            visible_ids = original_all.index.intersection(filtered_df["id"].dropna().astype("int64"))
+            original_visible = original_all.loc[visible_ids, ["id"] + EDITABLE_COLUMNS]
+            original_visible.index.name = None  # "id" as both index name and column would make merge ambiguous
+
+            if not is_datetime64_any_dtype(original_visible["Date"]):
                 original_visible["Date"] = pd.to_datetime(original_visible["Date"])
+            if not is_datetime64_any_dtype(current["Date"]):
                 current["Date"] = pd.to_datetime(current["Date"])
 
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-
+            # 🔗 Outer join on id: right_only rows were deleted, left_only rows are new, "both" rows may have been edited
+            merged = current.merge(
+                original_visible, on="id", how="outer",
+                suffixes=("", "_old"), indicator=True
+            )
+            deleted_rows = merged[merged["_merge"] == "right_only"]
+            new_rows = merged[(merged["_merge"] == "left_only") & merged["id"].isna()]
+            kept_rows = merged[merged["_merge"] == "both"]
+            changed_mask = np.zeros(len(kept_rows), dtype=bool)
+            for column in EDITABLE_COLUMNS:
+                new_values = kept_rows[column].astype(object)
+                old_values = kept_rows[f"{column}_old"].astype(object)
+                changed_mask |= ~((new_values == old_values) | (new_values.isna() & old_values.isna())).to_numpy()
+            # Rows given an id by hand that was not loaded here are still written as updates, as before
+            changed_rows = pd.concat([
+                kept_rows[changed_mask],
+                merged[(merged["_merge"] == "left_only") & merged["id"].notna()]
+            ])
+
+            deletes = [(int(i),) for i in deleted_rows["id"]]
+            inserts = save_params(new_rows)
+            updates = [params + (int(record_id),) for params, record_id in zip(save_params(changed_rows), changed_rows["id"])]
+
+            conn = get_db()
+            c = conn.cursor()
+            c.execute("BEGIN")
+            try:
                 # ✅ Delete rows manually removed from the filtered view
-                ids_before = set(original_visible["id"])
-                ids_after = set(current["id"].dropna())
-                deleted_ids = ids_before - ids_after
-                for deleted_id in deleted_ids:
-                    c.execute("DELETE FROM attendance WHERE id = ?", (deleted_id,))
-
-                # 📝 Insert or update rows
-                for _, row in current.iterrows():
-                    row_date = row["Date"].date() if isinstance(row["Date"], pd.Timestamp) else pd.to_datetime(row["Date"]).date()
-                    if pd.isna(row["id"]):
-                        c.execute("""
-                            INSERT INTO attendance (full_name, reg_no, date, time, status)
-                            VALUES (?, ?, ?, ?, ?)
-                        """, (
-                            row["Full Name"], row["Reg. No"], str(row_date),
-                            row["Time"], row["Status"]
-                        ))
-                    else:
-                        c.execute("""
-                            UPDATE attendance
-                            SET full_name = ?, reg_no = ?, date = ?, time = ?, status = ?
-                            WHERE id = ?
-                        """, (
-                            row["Full Name"], row["Reg. No"], str(row_date),
-                            row["Time"], row["Status"], int(row["id"])
-                        ))
-
-                conn.commit()
-                conn.close()
-                st.success("✅ Changes saved successfully.")
-                st.session_state.data_changed = False
-                st.session_state.confirm_save = False
-                st.rerun()
-            else:
-                st.warning("☑ Please confirm save before proceeding.")
+                c.executemany("DELETE FROM attendance WHERE id = ?", deletes)
+
+                # 📝 Insert new rows and update only the rows that actually changed
+                c.executemany("""
+                    INSERT INTO attendance (full_name, reg_no, date, time, status, time_s)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, inserts)
+                c.executemany("""
+                    UPDATE attendance
+                    SET full_name = ?, reg_no = ?, date = ?, time = ?, status = ?, time_s = ?
+                    WHERE id = ?
+                """, updates)
+            except BaseException:
+                # The connection outlives this run; never leave it inside a transaction holding the write lock
+                conn.rollback()
+                raise
+            conn.commit()
+            st.success("✅ Changes saved successfully.")
+            st.session_state.data_changed = False
+            st.session_state.confirm_save = False
+            st.rerun()
+        elif st.session_state.data_changed:
+            st.warning("☑ Please confirm save before proceeding.")
         else:
             st.info("No changes to save.")
 
     st.session_state.confirm_save = st.checkbox("✔ Confirm save changes", value=st.session_state.confirm_save)
 
 with col_export:
-    csv = filtered_df.to_csv(index=False)
+    csv = encode_csv(filter_key, filtered_df)
     st.download_button(
         label="📥 Download CSV",
         data=csv,